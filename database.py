@@ -6,6 +6,7 @@ Import and use these functions in your API endpoints for database operations.
 """
 
 from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -17,6 +18,8 @@ load_dotenv()
 
 _client = None
 db = None
+_async_client = None
+async_db = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
@@ -24,6 +27,10 @@ database_name = os.getenv("DATABASE_NAME")
 if database_url and database_name:
     _client = MongoClient(database_url)
     db = _client[database_name]
+    # the sync client backs the sync helpers below for scripts and other
+    # non-async callers; the app's endpoints all go through async_db
+    _async_client = AsyncIOMotorClient(database_url)
+    async_db = _async_client[database_name]
 
 # Helper functions for common database operations
 def create_document(collection_name: str, data: Union[BaseModel, dict]):
@@ -37,8 +44,9 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
     result = db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
@@ -53,3 +61,21 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
         cursor = cursor.limit(limit)
     
     return list(cursor)
+
+# Async variants for use inside async endpoints (Motor)
+async def create_document_async(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp without blocking the event loop"""
+    if async_db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    if isinstance(data, BaseModel):
+        data_dict = data.model_dump()
+    else:
+        data_dict = data.copy()
+
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
+
+    result = await async_db[collection_name].insert_one(data_dict)
+    return str(result.inserted_id)
@@ -1,15 +1,23 @@
 import os
+import asyncio
+import logging
 import string
 import random
-from typing import List, Optional, Dict, Any
+import time
+import msgspec
+import redis.asyncio as aioredis
+from typing import Annotated, Optional, Dict, Any, Set, Tuple
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from pydantic import AfterValidator, BaseModel, Field
 from datetime import datetime, timezone
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
-from database import db, create_document, get_documents
+from database import async_db, create_document_async
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
 app.add_middleware(
     CORSMiddleware,
@@ -22,6 +30,10 @@ app.add_middleware(
 # -----------------------------
 # Models
 # -----------------------------
+# room codes are case-insensitive; normalize request bodies on validation.
+# FastAPI drops Annotated validators on path params, so routes upper() those.
+CodeStr = Annotated[str, AfterValidator(str.upper)]
+
 class CreateRoomRequest(BaseModel):
     name: str
     avatar: Optional[str] = None
@@ -29,22 +41,34 @@ class CreateRoomRequest(BaseModel):
 class JoinRoomRequest(BaseModel):
     name: str
     avatar: Optional[str] = None
-    code: str
+    code: CodeStr
 
 class StartGameRequest(BaseModel):
-    code: str
+    code: CodeStr
+
+class WSMsg(msgspec.Struct):
+    type: str  # "state" | "chat"
+    player_id: str
+    payload: Dict[str, Any] = msgspec.field(default_factory=dict)
+
+# built once; decoding straight into WSMsg validates while it parses
+_ws_decoder = msgspec.json.Decoder(WSMsg)
+_ws_encoder = msgspec.json.Encoder()
 
 # -----------------------------
 # Helpers
 # -----------------------------
 
+_CHARS = string.ascii_uppercase + string.digits
+_UTC = timezone.utc
+
+
 def gen_code(length: int = 6) -> str:
-    chars = string.ascii_uppercase + string.digits
-    return "".join(random.choice(chars) for _ in range(length))
+    return "".join(random.choices(_CHARS, k=length))
 
 
 def now_iso() -> str:
-    return datetime.now(timezone.utc).isoformat()
+    return datetime.now(_UTC).isoformat()
 
 
 # -----------------------------
@@ -52,47 +76,236 @@ def now_iso() -> str:
 # -----------------------------
 ROOMS_COLLECTION = "gameroom"
 PLAYERS_COLLECTION = "player"
-
-
-def get_room_by_code(code: str) -> Optional[Dict[str, Any]]:
-    rooms = get_documents(ROOMS_COLLECTION, {"code": code}, limit=1)
-    return rooms[0] if rooms else None
+ROOM_CODE_ATTEMPTS = 6
+ROOM_CACHE_TTL = 3.0
+# only the fields the endpoints read
+ROOM_PROJECTION = {"_id": 0, "code": 1, "host_id": 1, "status": 1, "players": 1}
+
+# code -> (fetched_at, room); short-lived so bursts of lookups hit Mongo once
+_room_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+# bumped on every invalidation so a lookup that raced a write doesn't store
+# the stale room it read
+_room_cache_epoch = 0
+_room_cache_swept_at = 0.0
+
+
+async def get_room_by_code(code: str) -> Optional[Dict[str, Any]]:
+    cached = _room_cache.get(code)
+    if cached is not None and time.monotonic() - cached[0] < ROOM_CACHE_TTL:
+        return cached[1]
+    if async_db is None:
+        raise HTTPException(status_code=503, detail="Database not available")
+    epoch = _room_cache_epoch
+    room = await async_db[ROOMS_COLLECTION].find_one({"code": code}, ROOM_PROJECTION)
+    if room is None:
+        _room_cache.pop(code, None)
+        return None
+    if epoch == _room_cache_epoch:
+        _cache_room(code, room)
+    return room
+
+
+def _cache_room(code: str, room: Dict[str, Any]) -> None:
+    global _room_cache_swept_at
+    now = time.monotonic()
+    # drop expired entries at most once per TTL so the cache stays bounded
+    if now - _room_cache_swept_at >= ROOM_CACHE_TTL:
+        for key in [k for k, (ts, _) in _room_cache.items() if now - ts >= ROOM_CACHE_TTL]:
+            del _room_cache[key]
+        _room_cache_swept_at = now
+    _room_cache[code] = (now, room)
+
+
+def invalidate_room(code: str) -> None:
+    global _room_cache_epoch
+    _room_cache_epoch += 1
+    _room_cache.pop(code, None)
 
 
 # -----------------------------
 # WebSocket connection manager
 # -----------------------------
+SEND_QUEUE_SIZE = 32
+BROADCAST_BATCH_SIZE = 50
+# cap sockets per room so a single broadcast has a bounded cost
+MAX_PER_ROOM = 64
+# with REDIS_URL set, broadcasts go through one pub/sub channel per room so
+# every uvicorn worker can deliver to the sockets it owns
+REDIS_URL = os.getenv("REDIS_URL")
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+ROOM_CHANNEL_PREFIX = "room:"
+
+# (outgoing queue, relay task)
+Connection = Tuple[asyncio.Queue, asyncio.Task]
+
+
 class ConnectionManager:
     def __init__(self):
-        # room_code -> set of websockets
-        self.active: Dict[str, List[WebSocket]] = {}
-
-    async def connect(self, room: str, websocket: WebSocket):
+        # room_code -> connections, each with its own send queue and relay task
+        self.active: Dict[str, Dict[WebSocket, Connection]] = {}
+        # close handshakes of evicted sockets, kept referenced until done
+        self._closing: Set[asyncio.Task] = set()
+        self._redis: Optional[aioredis.Redis] = None
+        self._pubsub: Optional[aioredis.client.PubSub] = None
+        self._listener: Optional[asyncio.Task] = None
+        # set once a room channel is subscribed; get_message fails before that
+        self._has_channels: Optional[asyncio.Event] = None
+
+    async def start_pubsub(self, url: str):
+        self._redis = aioredis.from_url(url)
+        self._pubsub = self._redis.pubsub()
+        # created here so it binds to the server's running loop
+        self._has_channels = asyncio.Event()
+        self._listener = asyncio.create_task(self._listen())
+
+    async def stop_pubsub(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+        self._redis = self._pubsub = self._listener = self._has_channels = None
+
+    async def connect(self, room: str, websocket: WebSocket) -> bool:
         await websocket.accept()
-        self.active.setdefault(room, []).append(websocket)
+        if len(self.active.get(room, ())) >= MAX_PER_ROOM:
+            await websocket.close(code=1008)
+            return False
+        if self._pubsub is not None and room not in self.active:
+            await self._pubsub.subscribe(ROOM_CHANNEL_PREFIX + room)
+            self._has_channels.set()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        task = asyncio.create_task(self._relay(room, websocket, queue))
+        self.active.setdefault(room, {})[websocket] = (queue, task)
+        return True
 
     def disconnect(self, room: str, websocket: WebSocket):
-        if room in self.active and websocket in self.active[room]:
-            self.active[room].remove(websocket)
-            if not self.active[room]:
-                del self.active[room]
-
-    async def broadcast(self, room: str, message: Dict[str, Any]):
         if room not in self.active:
             return
-        living = []
-        for ws in self.active[room]:
+        conn = self.active[room].pop(websocket, None)
+        if conn is not None:
+            conn[1].cancel()
+        if not self.active[room]:
+            del self.active[room]
+
+    def _evict(self, room: str, websocket: WebSocket):
+        # a lagging client may take close_timeout to finish the handshake,
+        # so close it in the background rather than in the broadcaster
+        self.disconnect(room, websocket)
+        task = asyncio.create_task(self._close(websocket))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, websocket: WebSocket):
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def _relay(self, room: str, websocket: WebSocket, queue: asyncio.Queue):
+        # drain this client's queue so a slow socket only delays itself
+        try:
+            while True:
+                payload = await queue.get()
+                await websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(room, websocket)
+
+    async def _listen(self):
+        while True:
             try:
-                await ws.send_json(message)
-                living.append(ws)
+                await self._listen_once()
+            except asyncio.CancelledError:
+                raise
             except Exception:
-                pass
-        self.active[room] = living
+                # e.g. Redis reconnecting; keep the listener alive
+                await asyncio.sleep(1.0)
+
+    async def _listen_once(self):
+        if not self._pubsub.subscribed:
+            self._has_channels.clear()
+            await self._has_channels.wait()
+        message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        if message is None:
+            return
+        channel = message["channel"]
+        room = channel.decode()[len(ROOM_CHANNEL_PREFIX):]
+        if room in self.active:
+            await self._fanout(room, message["data"].decode())
+            return
+        # no local sockets left in this room; stop receiving it
+        await self._pubsub.unsubscribe(channel)
+        if room in self.active:
+            await self._pubsub.subscribe(channel)
+            self._has_channels.set()
+
+    async def broadcast(self, room: str, payload: bytes):
+        # payload is encoded once by the caller; send_json would re-encode per socket
+        if self._redis is not None:
+            await self._redis.publish(ROOM_CHANNEL_PREFIX + room, payload)
+        else:
+            await self._fanout(room, payload.decode())
+
+    async def _fanout(self, room: str, payload: str):
+        if room not in self.active:
+            return
+        conns = self.active[room]
+        # rooms that fit in one batch never yield, so the dict can't change
+        # under us; only big rooms need a snapshot
+        total = len(conns)
+        items = conns.items() if total <= BROADCAST_BATCH_SIZE else list(conns.items())
+        # failures are rare, so only they are collected
+        lagging = []
+        for i, (ws, (queue, _)) in enumerate(items, 1):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                lagging.append(ws)
+            # yield between batches so a big room doesn't starve other handlers
+            if i % BROADCAST_BATCH_SIZE == 0 and i < total:
+                await asyncio.sleep(0)
+        # drop clients that can't keep up instead of buffering without bound
+        for ws in lagging:
+            self._evict(room, ws)
 
 
 manager = ConnectionManager()
 
 
+@app.on_event("startup")
+async def start_pubsub():
+    if REDIS_URL:
+        await manager.start_pubsub(REDIS_URL)
+    elif WEB_CONCURRENCY > 1:
+        logger.warning(
+            "WEB_CONCURRENCY=%d without REDIS_URL: each worker only broadcasts "
+            "to its own sockets, so rooms are split across workers",
+            WEB_CONCURRENCY,
+        )
+
+
+@app.on_event("shutdown")
+async def stop_pubsub():
+    await manager.stop_pubsub()
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    if async_db is None:
+        return
+    # every room lookup filters on code; players are only fetched by _id,
+    # which MongoDB always indexes
+    try:
+        await async_db[ROOMS_COLLECTION].create_index([("code", ASCENDING)], unique=True)
+    except PyMongoError as e:
+        # unreachable DB or existing duplicate codes; /test reports DB status
+        logger.warning("Could not create unique index on %s.code: %s", ROOMS_COLLECTION, e)
+
+
 # -----------------------------
 # Basic endpoints
 # -----------------------------
@@ -102,7 +315,7 @@ def read_root():
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -113,13 +326,13 @@ def test_database():
     }
 
     try:
-        if db is not None:
+        if async_db is not None:
             response["database"] = "✅ Available"
             response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-            response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
+            response["database_name"] = async_db.name if hasattr(async_db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await async_db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -136,66 +349,74 @@ def test_database():
 # Room management endpoints
 # -----------------------------
 @app.post("/rooms/create")
-def create_room(payload: CreateRoomRequest):
+async def create_room(payload: CreateRoomRequest):
+    ts = now_iso()
     # create player
-    player_id = create_document(
+    player_id = await create_document_async(
         PLAYERS_COLLECTION,
         {
             "name": payload.name,
             "avatar": payload.avatar,
-            "created_at": now_iso(),
+            "created_at": ts,
         },
     )
-    # generate unique code
-    tries = 0
-    code = gen_code()
-    while get_room_by_code(code) is not None and tries < 5:
-        code = gen_code()
-        tries += 1
-
     room_doc = {
-        "code": code,
+        "code": gen_code(),
         "host_id": player_id,
         "status": "waiting",
         "players": [player_id],
-        "created_at": now_iso(),
-        "updated_at": now_iso(),
+        "created_at": ts,
+        "updated_at": ts,
     }
-    create_document(ROOMS_COLLECTION, room_doc)
+    # the unique index on code rejects collisions; retry with a fresh code
+    for _ in range(ROOM_CODE_ATTEMPTS):
+        try:
+            await create_document_async(ROOMS_COLLECTION, room_doc)
+            break
+        except DuplicateKeyError:
+            room_doc["code"] = gen_code()
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate a room code")
+    code = room_doc["code"]
     return {"code": code, "player_id": player_id, "status": "waiting"}
 
 
 @app.post("/rooms/join")
-def join_room(payload: JoinRoomRequest):
-    room = get_room_by_code(payload.code.upper())
+async def join_room(payload: JoinRoomRequest):
+    room = await get_room_by_code(payload.code)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
     if room.get("status") == "active":
         raise HTTPException(status_code=400, detail="Game already started")
 
-    player_id = create_document(
+    ts = now_iso()
+    player_id = await create_document_async(
         PLAYERS_COLLECTION,
         {
             "name": payload.name,
             "avatar": payload.avatar,
-            "created_at": now_iso(),
+            "created_at": ts,
         },
     )
 
-    # push player to room
-    db[ROOMS_COLLECTION].update_one({"code": room["code"]}, {"$addToSet": {"players": player_id}, "$set": {"updated_at": now_iso()}})
+    # push player to room; the status filter is the real guard, since the
+    # room read above may be cached or stale by now
+    result = await async_db[ROOMS_COLLECTION].update_one(
+        {"code": room["code"], "status": {"$ne": "active"}},
+        {"$addToSet": {"players": player_id}, "$set": {"updated_at": ts}},
+    )
+    invalidate_room(room["code"])
+    if result.matched_count == 0:
+        raise HTTPException(status_code=400, detail="Game already started")
 
     return {"code": room["code"], "player_id": player_id}
 
 
 @app.get("/rooms/{code}")
-def get_room(code: str):
-    room = get_room_by_code(code.upper())
+async def get_room(code: str):
+    room = await get_room_by_code(code.upper())
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    # fetch player names for convenience
-    players = list(db[PLAYERS_COLLECTION].find({"_id": {"$in": [db[PLAYERS_COLLECTION].name and __import__('bson').ObjectId(pid) if len(pid)==24 else None for pid in room.get('players', [])]}}))
-    # Above is potentially messy due to ObjectId; return just IDs
     return {
         "code": room["code"],
         "host_id": room["host_id"],
@@ -205,11 +426,12 @@ def get_room(code: str):
 
 
 @app.post("/rooms/start")
-def start_game(payload: StartGameRequest):
-    room = get_room_by_code(payload.code.upper())
+async def start_game(payload: StartGameRequest):
+    room = await get_room_by_code(payload.code)
     if not room:
         raise HTTPException(status_code=404, detail="Room not found")
-    db[ROOMS_COLLECTION].update_one({"code": room["code"]}, {"$set": {"status": "active", "updated_at": now_iso()}})
+    await async_db[ROOMS_COLLECTION].update_one({"code": room["code"]}, {"$set": {"status": "active", "updated_at": now_iso()}})
+    invalidate_room(room["code"])
     return {"ok": True}
 
 
@@ -219,12 +441,20 @@ def start_game(payload: StartGameRequest):
 @app.websocket("/ws/rooms/{code}")
 async def ws_room(websocket: WebSocket, code: str):
     code = code.upper()
-    await manager.connect(code, websocket)
+    if not await manager.connect(code, websocket):
+        return
     try:
         while True:
-            data = await websocket.receive_json()
-            # Expected payload: {"type": "state"|"chat", "player_id": "...", "payload": {...}}
-            await manager.broadcast(code, data)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            raw = message.get("text") or message.get("bytes")
+            try:
+                msg = _ws_decoder.decode(raw)
+            except (msgspec.DecodeError, TypeError):
+                # skip malformed frames instead of dropping the connection
+                continue
+            await manager.broadcast(code, _ws_encoder.encode(msg))
     except WebSocketDisconnect:
         manager.disconnect(code, websocket)
     except Exception:
@@ -234,4 +464,12 @@ async def ws_room(websocket: WebSocket, code: str):
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=WEB_CONCURRENCY,
+        loop="uvloop",
+        http="httptools",
+        ws="websockets",
+    )